@@ -437,7 +437,7 @@ def main():
         # Run with one process
         if n_threads <= 1 or n_reads < 1000001:
             print("CITE-seq-Count is running with one core.")
-            (_final_results, _merged_no_match) = processing.map_reads(
+            mapping_result = processing.map_reads(
                 read1_path=read1_path,
                 read2_path=read2_path,
                 tags=ab_map,
@@ -451,13 +451,13 @@ def main():
                 sliding_window=args.sliding_window,
             )
             print("Mapping done")
-            _umis_per_cell = Counter()
-            _reads_per_cell = Counter()
-            for cell_barcode, counts in _final_results.items():
-                _umis_per_cell[cell_barcode] = sum([len(counts[UMI]) for UMI in counts])
-                _reads_per_cell[cell_barcode] = sum(
-                    [sum(counts[UMI].values()) for UMI in counts]
-                )
+            (
+                _final_results,
+                _umis_per_cell,
+                _reads_per_cell,
+                _merged_no_match,
+            ) = processing.merge_results(parallel_results=[mapping_result])
+            del mapping_result
         else:
             # Run with multiple processes
             print("CITE-seq-Count is running with {} cores.".format(n_threads))
@@ -511,6 +511,8 @@ def main():
                 else:
                     # Explicitly save the counter to that tag
                     final_results[cell_barcode][tag] = _final_results[cell_barcode][tag]
+        # Release the per-file results once they are merged
+        del _final_results
     ordered_tags_map = OrderedDict()
     for i, tag in enumerate(ab_map.values()):
         ordered_tags_map[tag] = i
@@ -552,6 +554,7 @@ def main():
                     whitelist=whitelist,
                     collapsing_threshold=args.bc_threshold,
                     ab_map=ordered_tags_map,
+                    n_threads=args.n_threads,
                 )
     else:
         bcs_corrected = 0
@@ -1,17 +1,16 @@
 import os
 import gzip
 import shutil
+import subprocess
 
-import pandas as pd
-
-from scipy import io
+import fast_matrix_market as fmm
 
 
 def write_to_files(sparse_matrix, top_cells, ordered_tags_map, data_type, outfolder):
     """Write the umi and read sparse matrices to file in gzipped mtx format.
 
     Args:
-        sparse_matrix (dok_matrix): Results in a sparse matrix.
+        sparse_matrix (coo_matrix): Results in a sparse matrix.
         top_cells (set): Set of cells that are selected for output.
         ordered_tags_map (dict): Tags in order with indexes as values.
         data_type (string): A string definning if the data is umi or read based.
@@ -19,25 +18,30 @@ def write_to_files(sparse_matrix, top_cells, ordered_tags_map, data_type, outfol
     """
     prefix = os.path.join(outfolder,data_type + '_count')
     os.makedirs(prefix, exist_ok=True)
-    io.mmwrite(os.path.join(prefix,'matrix.mtx'),sparse_matrix)
-    with gzip.open(os.path.join(prefix,'barcodes.tsv.gz'), 'wb') as barcode_file:
-        for barcode in top_cells:
-            barcode_file.write('{}\n'.format(barcode).encode())
-    with gzip.open(os.path.join(prefix,'features.tsv.gz'), 'wb') as feature_file:
-        for feature in ordered_tags_map:
-            feature_file.write('{}\n'.format(feature).encode())
-    with open(os.path.join(prefix,'matrix.mtx'),'rb') as mtx_in:
-        with gzip.open(os.path.join(prefix,'matrix.mtx') + '.gz','wb') as mtx_gz:
-            shutil.copyfileobj(mtx_in, mtx_gz)
-    os.remove(os.path.join(prefix,'matrix.mtx'))
+    mtx_path = os.path.join(prefix,'matrix.mtx')
+    if shutil.which('pigz'):
+        # pigz compresses the biggest output file on all cores.
+        fmm.mmwrite(mtx_path, sparse_matrix.tocoo(), symmetry='general')
+        subprocess.run(['pigz', '-1', '-f', mtx_path], check=True)
+    else:
+        with gzip.open(mtx_path + '.gz', 'wb', compresslevel=1) as mtx_file:
+            fmm.mmwrite(mtx_file, sparse_matrix.tocoo(), symmetry='general')
+    with gzip.open(os.path.join(prefix,'barcodes.tsv.gz'), 'wb', compresslevel=1) as barcode_file:
+        # One coalesced write instead of one small write per barcode.
+        barcode_file.write(''.join('{}\n'.format(barcode) for barcode in top_cells).encode())
+    with gzip.open(os.path.join(prefix,'features.tsv.gz'), 'wb', compresslevel=1) as feature_file:
+        feature_file.write(''.join('{}\n'.format(feature) for feature in ordered_tags_map).encode())
 
 
 def write_dense(sparse_matrix, index, columns, outfolder, filename):
     """
     Writes a dense matrix in a csv format
-    
+
+    The matrix is streamed row by row instead of materializing a full
+    dense copy in memory.
+
     Args:
-       sparse_matrix (dok_matrix): Results in a sparse matrix.
+       sparse_matrix (coo_matrix): Results in a sparse matrix.
        index (list): List of TAGS
        columns (set): List of cells
        outfolder (str): Output folder
@@ -45,8 +49,12 @@ def write_dense(sparse_matrix, index, columns, outfolder, filename):
     """
     prefix = os.path.join(outfolder)
     os.makedirs(prefix, exist_ok=True)
-    pandas_dense = pd.DataFrame(sparse_matrix.todense(), columns=columns, index=index)
-    pandas_dense.to_csv(os.path.join(outfolder,filename), sep='\t')
+    csr_matrix = sparse_matrix.tocsr()
+    with open(os.path.join(outfolder,filename), 'w') as dense_file:
+        dense_file.write('\t' + '\t'.join(str(column) for column in columns) + '\n')
+        for i, tag in enumerate(index):
+            row = csr_matrix.getrow(i).toarray().ravel()
+            dense_file.write(tag + '\t' + '\t'.join(map(str, row)) + '\n')
 
 
 def write_unmapped(merged_no_match, top_unknowns, outfolder, filename):
@@ -64,5 +72,4 @@ def write_unmapped(merged_no_match, top_unknowns, outfolder, filename):
 
     with open(os.path.join(outfolder, filename),'w') as unknown_file:
         unknown_file.write('tag,count\n')
-        for element in top_unmapped:
-            unknown_file.write('{},{}\n'.format(element[0],element[1]))
+        unknown_file.write(''.join('{},{}\n'.format(element[0],element[1]) for element in top_unmapped))
@@ -1,9 +1,12 @@
 import csv
 import gzip
+import io
 import sys
 import regex
 import Levenshtein
 
+import numpy as np
+
 from math import floor
 from collections import OrderedDict
 from itertools import combinations
@@ -103,6 +106,11 @@ def test_cell_distances(whitelist, collapsing_threshold):
     Returns:
         collapsing_threshold (int): Valid threshold
     """
+    whitelist_ordered = list(whitelist)
+    barcode_length = len(whitelist_ordered[0])
+    whitelist_arr = np.frombuffer(
+        "".join(whitelist_ordered).encode("ascii"), dtype=np.uint8
+    ).reshape(-1, barcode_length)
     ok = False
     while not ok:
         print(
@@ -110,9 +118,13 @@ def test_cell_distances(whitelist, collapsing_threshold):
                 collapsing_threshold
             )
         )
-        all_comb = combinations(whitelist, 2)
-        for comb in all_comb:
-            if Levenshtein.hamming(comb[0], comb[1]) <= collapsing_threshold:
+        # Compare each barcode to all following ones in one vectorized pass
+        # instead of one Python-level hamming call per pair.
+        for i in range(len(whitelist_ordered) - 1):
+            distances = np.count_nonzero(
+                whitelist_arr[i + 1 :] != whitelist_arr[i], axis=1
+            )
+            if int(distances.min()) <= collapsing_threshold:
                 collapsing_threshold -= 1
                 print("Value is too high, reducing it by 1")
                 break
@@ -205,6 +217,52 @@ def check_tags(tags, maximum_distance):
     return ordered_tags
 
 
+def convert_tags_to_arrays(tags):
+    """Converts the TAG sequences into a numpy uint8 matrix.
+
+    Each TAG is encoded as one row of ASCII byte values. Shorter TAGs are
+    padded with the sentinel byte 255 so that the matrix stays rectangular;
+    padded positions are ignored when computing Hamming distances.
+
+    Args:
+        tags (dict): A dictionary with the TAGs as keys and TAG Names as values.
+
+    Returns:
+        tags_arr (numpy.ndarray): A (n_tags, tag_len) uint8 matrix of TAG bytes.
+        tag_names (list): TAG names in the same order as the matrix rows.
+        tag_len (int): Length of the longest TAG.
+    """
+    tag_names = list(tags.values())
+    tag_len = max(len(tag) for tag in tags)
+    tags_arr = np.full((len(tags), tag_len), 255, dtype=np.uint8)
+    for i, tag in enumerate(tags):
+        tags_arr[i, : len(tag)] = np.frombuffer(tag.encode("ascii"), dtype=np.uint8)
+    return (tags_arr, tag_names, tag_len)
+
+
+# Read buffer size for gzipped FASTQ streaming. The default buffer makes
+# zlib call-site heavy for multi-GB files; a few MB amortizes the inflates.
+FASTQ_BUFFER_SIZE = 4 * 1024 * 1024
+
+
+def open_fastq(filename, mode="rt"):
+    """Opens a gzipped FASTQ file with a large read buffer.
+
+    Args:
+        filename (str): Path to a fastq.gz file.
+        mode (str): "rt" for a text stream, "rb" for a binary stream.
+
+    Returns:
+        io.IOBase: A buffered file object over the decompressed stream.
+    """
+    buffered = io.BufferedReader(
+        gzip.open(filename, "rb"), buffer_size=FASTQ_BUFFER_SIZE
+    )
+    if mode == "rt":
+        return io.TextIOWrapper(buffered, encoding="utf-8", errors="ignore")
+    return buffered
+
+
 def get_read_length(filename):
     """Check wether SEQUENCE lengths are consistent in a FASTQ file and return
     the length.
@@ -216,7 +274,7 @@ def get_read_length(filename):
         int: The file's SEQUENCE length.
 
     """
-    with gzip.open(filename, "r") as fastq_file:
+    with open_fastq(filename, "rb") as fastq_file:
         secondlines = islice(fastq_file, 1, 1000, 4)
         temp_length = len(next(secondlines).rstrip())
         for sequence in secondlines:
@@ -302,8 +360,8 @@ def get_n_lines(file_path):
         n_lines (int): Number of lines in the file
     """
     print("Counting number of reads")
-    with gzip.open(file_path, "rt", encoding="utf-8", errors="ignore") as f:
-        n_lines = sum(bl.count("\n") for bl in blocks(f))
+    with open_fastq(file_path, "rb") as f:
+        n_lines = sum(bl.count(b"\n") for bl in blocks(f))
     if n_lines % 4 != 0:
         sys.exit(
             "{}'s number of lines is not a multiple of 4. The file "
@@ -1,16 +1,21 @@
 import time
-import gzip
 import sys
 import os
+import ahocorasick
 import Levenshtein
 import regex
-import pybktree
 
 from collections import Counter
 from collections import defaultdict
+from math import ceil
 from multiprocess import Pool
 
 from itertools import islice
+
+import numpy as np
+
+from numba import njit
+from numba import prange
 from numpy import int32
 from scipy import sparse
 from umi_tools import network
@@ -22,14 +27,94 @@ from cite_seq_count import secondsToText
 from cite_seq_count import preprocessing
 
 
+# How many reads are encoded and mapped per kernel call in map_reads.
+MAPPING_BATCH_SIZE = 1000000
+
+# Largest cell/tag group clustered with the vectorized pairwise distances.
+MAX_VECTORIZED_UMIS = 2000
+
+# Cache of the uint8 TAG matrices so that per-read calls do not rebuild them.
+_tag_arrays_cache = {}
+
+# Cache of the exact-match lookup dicts built from the TAG sequences.
+_exact_index_cache = {}
+
+# Cache of the Aho-Corasick automatons built from the TAG sequences.
+_tag_automaton_cache = {}
+
+
+def _get_tag_automaton(tags):
+    """
+    Fetch or build the Aho-Corasick automaton of the TAG sequences.
+
+    Args:
+        tags (dict): A dictionary with the TAGs as keys and TAG Names as values.
+
+    Returns:
+        automaton (ahocorasick.Automaton): Automaton matching any TAG sequence.
+    """
+    cache_key = tuple(tags)
+    automaton = _tag_automaton_cache.get(cache_key)
+    if automaton is None:
+        automaton = ahocorasick.Automaton()
+        for tag, name in tags.items():
+            automaton.add_word(tag, name)
+        automaton.make_automaton()
+        _tag_automaton_cache[cache_key] = automaton
+    return automaton
+
+
+def _get_exact_index(tags):
+    """
+    Fetch or build the exact-match lookup for the TAGs.
+
+    Args:
+        tags (dict): A dictionary with the TAGs as keys and TAG Names as values.
+
+    Returns:
+        prefix_to_index (dict): TAG sequence as bytes to TAG index.
+        prefix_lengths (list): Distinct TAG lengths, longest first.
+    """
+    cache_key = tuple(tags)
+    cached = _exact_index_cache.get(cache_key)
+    if cached is None:
+        prefix_to_index = {
+            tag.encode("ascii"): index for index, tag in enumerate(tags)
+        }
+        prefix_lengths = sorted({len(tag) for tag in tags}, reverse=True)
+        cached = (prefix_to_index, prefix_lengths)
+        _exact_index_cache[cache_key] = cached
+    return cached
+
+
+def _get_tag_arrays(tags):
+    """
+    Fetch or build the uint8 matrix representation of the TAGs.
+
+    Args:
+        tags (dict): A dictionary with the TAGs as keys and TAG Names as values.
+
+    Returns:
+        tags_arr (numpy.ndarray): A (n_tags, tag_len) uint8 matrix of TAG bytes.
+        tag_names (list): TAG names in the same order as the matrix rows.
+        tag_len (int): Length of the longest TAG.
+    """
+    cache_key = tuple(tags)
+    cached = _tag_arrays_cache.get(cache_key)
+    if cached is None:
+        cached = preprocessing.convert_tags_to_arrays(tags)
+        _tag_arrays_cache[cache_key] = cached
+    return cached
+
+
 def find_best_match(TAG_seq, tags, maximum_distance):
     """
     Find the best match from the list of tags.
 
-    Compares the Levenshtein distance between tags and the trimmed sequences.
-    The tag and the sequence must have the same length.
+    Computes the Hamming distance between all tags and the trimmed sequence
+    in one vectorized numpy pass over the uint8 TAG matrix. Padded positions
+    of shorter tags are excluded from their distances.
     If no matches found returns 'unmapped'.
-    We add 1
     Args:
         TAG_seq (string): Sequence from R1 already start trimmed
         tags (dict): A dictionary with the TAGs as keys and TAG Names as values.
@@ -38,18 +123,64 @@ def find_best_match(TAG_seq, tags, maximum_distance):
     Returns:
         best_match (string): The TAG name that will be used for counting.
     """
-    best_match = "unmapped"
-    best_score = maximum_distance
-    for tag, name in tags.items():
-        score = Levenshtein.hamming(tag, TAG_seq[: len(tag)])
-        if score == 0:
-            # Best possible match
-            return name
-        elif score <= best_score:
-            best_score = score
-            best_match = name
-            return best_match
-    return best_match
+    (tags_arr, tag_names, tag_len) = _get_tag_arrays(tags)
+    if isinstance(TAG_seq, str):
+        TAG_seq = TAG_seq.encode("ascii", "ignore")
+    # Exact matches are the majority for well-designed panels; try the O(1)
+    # lookup before the Hamming pass.
+    (prefix_to_index, prefix_lengths) = _get_exact_index(tags)
+    for length in prefix_lengths:
+        index = prefix_to_index.get(TAG_seq[:length])
+        if index is not None:
+            return tag_names[index]
+    read_arr = np.frombuffer(
+        TAG_seq[:tag_len].ljust(tag_len, b"\x00"), dtype=np.uint8
+    )
+    distances = np.count_nonzero((tags_arr != read_arr) & (tags_arr != 255), axis=1)
+    best_index = int(distances.argmin())
+    if distances[best_index] <= maximum_distance:
+        return tag_names[best_index]
+    return "unmapped"
+
+
+@njit(parallel=True, cache=True)
+def _map_reads_kernel(reads_arr, tags_arr, tag_lengths, maximum_distance):
+    """
+    Batched Hamming matching of reads against all TAGs.
+
+    Compiled with numba so the per-read loop runs as native parallel code
+    instead of interpreted Python.
+
+    Args:
+        reads_arr (numpy.ndarray): A (n_reads, tag_len) uint8 matrix of read bytes.
+        tags_arr (numpy.ndarray): A (n_tags, tag_len) uint8 matrix of TAG bytes.
+        tag_lengths (numpy.ndarray): Length of each TAG.
+        maximum_distance (int): Maximum distance given by the user.
+
+    Returns:
+        best_indexes (numpy.ndarray): Index of the best TAG per read. The
+            value n_tags means the read is unmapped.
+    """
+    n_reads = reads_arr.shape[0]
+    n_tags = tags_arr.shape[0]
+    best_indexes = np.empty(n_reads, dtype=np.int32)
+    for i in prange(n_reads):
+        best_index = n_tags
+        best_score = maximum_distance + 1
+        for t in range(n_tags):
+            score = 0
+            for k in range(tag_lengths[t]):
+                if tags_arr[t, k] != reads_arr[i, k]:
+                    score += 1
+                    if score >= best_score:
+                        break
+            if score < best_score:
+                best_score = score
+                best_index = t
+                if score == 0:
+                    break
+        best_indexes[i] = best_index
+    return best_indexes
 
 
 def find_best_match_shift(TAG_seq, tags, maximum_distance):
@@ -68,20 +199,21 @@ def find_best_match_shift(TAG_seq, tags, maximum_distance):
     Returns:
         best_match (string): The TAG name that will be used for counting.
     """
+    # One DFA scan over the read finds any exact TAG occurrence, replacing
+    # the per-shift per-tag comparison for the common case.
+    for _, name in _get_tag_automaton(tags).iter(TAG_seq):
+        return name
+
     best_match = "unmapped"
-    best_score = maximum_distance
+    best_score = maximum_distance + 1
     shifts = range(0, len(TAG_seq) - len(max(tags, key=len)))
 
     for shift in shifts:
         for tag, name in tags.items():
             score = Levenshtein.hamming(tag, TAG_seq[shift : len(tag) + shift])
-            if score == 0:
-                # Best possible match
-                return name
-            elif score <= best_score:
+            if score < best_score:
                 best_score = score
                 best_match = name
-                return best_match
     return best_match
 
 
@@ -119,88 +251,202 @@ def map_reads(
         sliding_window (bool): A bool enabling a sliding window search
 
     Returns:
-        results (dict): A dict of dict of Counters with the mapping results.
+        flat_results (Counter): Counter of reads keyed by (cell barcode, TAG, UMI).
         no_match (Counter): A counter with unmapped sequences.
+        umis_per_cell (Counter): Total umis per cell as a Counter
+        reads_per_cell (Counter): Total reads per cell as a Counter
     """
     # Initiate values
-    results = {}
+    # Cell barcodes and UMIs are interned to integer ids; the per-read stream
+    # is kept as id triplet arrays and aggregated once at the end with
+    # np.unique/np.bincount instead of per-read Counter updates.
+    cb_index = {}
+    cb_names = []
+    umi_index = {}
+    umi_names = []
+    cb_id_arrays = []
+    umi_id_arrays = []
+    tag_id_arrays = []
     no_match = Counter()
     n = 1
     t = time.time()
-    with gzip.open(read1_path, "rt") as textfile1, gzip.open(
-        read2_path, "rt"
-    ) as textfile2:
+    (tags_arr, tag_names, tag_len) = _get_tag_arrays(tags)
+    (prefix_to_index, prefix_lengths) = _get_exact_index(tags)
+    tag_name_to_index = {name: index for index, name in enumerate(tag_names)}
+    tag_lengths = np.array([len(tag) for tag in tags], dtype=np.int64)
+    n_tags = len(tag_names)
+    # Fixed-width record layout for the batch buffer: CB + UMI + trimmed R2.
+    cb_len = barcode_slice.stop - barcode_slice.start
+    umi_len = umi_slice.stop - umi_slice.start
+    r2_offset = cb_len + umi_len
+    r2_len = None
+    with preprocessing.open_fastq(
+        read1_path, "rb"
+    ) as textfile1, preprocessing.open_fastq(read2_path, "rb") as textfile2:
 
         # Read all 2nd lines from 4 line chunks. If first_n not None read only 4 times the given amount.
         secondlines = islice(
             zip(textfile1, textfile2), indexes[0] * 4 + 1, indexes[1] * 4 + 1, 4
         )
-        for read1, read2 in secondlines:
-            read1 = read1.strip()
-            read2 = read2.strip()
-
-            # Progress info
-            if n % 1000000 == 0:
-                print(
-                    "Processed 1,000,000 reads in {}. Total "
-                    "reads: {:,} in child {}".format(
-                        secondsToText.secondsToText(time.time() - t), n, os.getpid()
-                    )
-                )
-                sys.stdout.flush()
-                t = time.time()
-
-            # Get cell and umi barcodes.
-            cell_barcode = read1[barcode_slice]
-            # This change in bytes is required by umi_tools for umi correction
-            UMI = bytes(read1[umi_slice], "ascii")
-            # Trim potential starting sequences
-            TAG_seq = read2[start_trim:]
-
-            if cell_barcode not in results:
-                results[cell_barcode] = defaultdict(Counter)
+        while True:
+            batch = list(islice(secondlines, MAPPING_BATCH_SIZE))
+            if not batch:
+                break
+            if r2_len is None:
+                r2_len = max(len(batch[0][1].strip()) - start_trim, tag_len)
+                reclen = cb_len + umi_len + r2_len
+            n_batch = len(batch)
+            records = bytearray()
+            best_indexes = np.empty(n_batch, dtype=np.int32)
+            for j, (read1, read2) in enumerate(batch):
+                read1 = read1.strip()
+                TAG_seq = read2.strip()[start_trim:]
+                # One fixed-width record per read, no delimiters.
+                records += (
+                    read1[barcode_slice] + read1[umi_slice] + TAG_seq
+                ).ljust(reclen, b"\x00")[:reclen]
+                # Exact matches skip the Hamming kernel entirely.
+                index = -1
+                for length in prefix_lengths:
+                    found = prefix_to_index.get(TAG_seq[:length])
+                    if found is not None:
+                        index = found
+                        break
+                best_indexes[j] = index
 
             if sliding_window:
-                best_match = find_best_match_shift(TAG_seq, tags, maximum_distance)
+                for i in range(n_batch):
+                    best_indexes[i] = tag_name_to_index.get(
+                        find_best_match_shift(
+                            records[i * reclen + r2_offset : (i + 1) * reclen]
+                            .rstrip(b"\x00")
+                            .decode("ascii"),
+                            tags,
+                            maximum_distance,
+                        ),
+                        n_tags,
+                    )
             else:
-                best_match = find_best_match(TAG_seq, tags, maximum_distance)
-
-            results[cell_barcode][best_match][UMI] += 1
-
-            if best_match == "unmapped":
-                no_match[TAG_seq] += 1
-
-            if debug:
-                print(
-                    "\nline:{0}\n"
-                    "cell_barcode:{1}\tUMI:{2}\tTAG_seq:{3}\n"
-                    "line length:{4}\tcell barcode length:{5}\tUMI length:{6}\tTAG sequence length:{7}\n"
-                    "Best match is: {8}".format(
-                        read1 + read2,
-                        cell_barcode,
-                        UMI,
-                        TAG_seq,
-                        len(read1 + read2),
-                        len(cell_barcode),
-                        len(UMI),
-                        len(TAG_seq),
-                        best_match,
+                # Zero-copy view over the record buffer; the kernel reads the
+                # strided R2 columns in place, only for the inexact reads.
+                miss_rows = np.nonzero(best_indexes < 0)[0]
+                if miss_rows.size:
+                    batch_arr = np.frombuffer(records, dtype=np.uint8).reshape(
+                        -1, reclen
                     )
+                    reads_arr = batch_arr[:, r2_offset : r2_offset + tag_len]
+                    best_indexes[miss_rows] = _map_reads_kernel(
+                        reads_arr[miss_rows], tags_arr, tag_lengths, maximum_distance
+                    )
+
+            batch_cb_ids = np.empty(n_batch, dtype=np.int64)
+            batch_umi_ids = np.empty(n_batch, dtype=np.int64)
+            for i in range(n_batch):
+                # Progress info
+                if n % 1000000 == 0:
+                    print(
+                        "Processed 1,000,000 reads in {}. Total "
+                        "reads: {:,} in child {}".format(
+                            secondsToText.secondsToText(time.time() - t), n, os.getpid()
+                        )
+                    )
+                    sys.stdout.flush()
+                    t = time.time()
+
+                record = records[i * reclen : (i + 1) * reclen]
+                cell_barcode = record[:cb_len].decode("ascii")
+                # UMIs stay as bytes, as required by umi_tools for umi correction
+                UMI = bytes(record[cb_len:r2_offset])
+
+                cb_id = cb_index.get(cell_barcode)
+                if cb_id is None:
+                    cb_id = len(cb_names)
+                    cb_index[cell_barcode] = cb_id
+                    cb_names.append(cell_barcode)
+                umi_id = umi_index.get(UMI)
+                if umi_id is None:
+                    umi_id = len(umi_names)
+                    umi_index[UMI] = umi_id
+                    umi_names.append(UMI)
+                batch_cb_ids[i] = cb_id
+                batch_umi_ids[i] = umi_id
+
+                if best_indexes[i] == n_tags:
+                    TAG_seq = record[r2_offset:].rstrip(b"\x00").decode("ascii")
+                    no_match[TAG_seq] += 1
+
+                if debug:
+                    TAG_seq = record[r2_offset:].rstrip(b"\x00").decode("ascii")
+                    print(
+                        "\ncell_barcode:{0}\tUMI:{1}\tTAG_seq:{2}\n"
+                        "cell barcode length:{3}\tUMI length:{4}\tTAG sequence length:{5}\n"
+                        "Best match is: {6}".format(
+                            cell_barcode,
+                            UMI,
+                            TAG_seq,
+                            len(cell_barcode),
+                            len(UMI),
+                            len(TAG_seq),
+                            tag_names[best_indexes[i]]
+                            if best_indexes[i] < n_tags
+                            else "unmapped",
+                        )
+                    )
+                    sys.stdout.flush()
+                n += 1
+            cb_id_arrays.append(batch_cb_ids)
+            umi_id_arrays.append(batch_umi_ids)
+            tag_id_arrays.append(best_indexes.astype(np.int64))
+    # Aggregate the id triplets: one np.unique histogram for the per-umi
+    # counts and bincounts for the per-cell totals. The chunk is returned
+    # as a flat Counter so merging across workers is a C-level update; the
+    # nested layout is only built once in merge_results.
+    flat_results = Counter()
+    umis_per_cell = Counter()
+    reads_per_cell = Counter()
+    if cb_id_arrays:
+        all_tag_names = tag_names + ["unmapped"]
+        cb_ids = np.concatenate(cb_id_arrays)
+        umi_ids = np.concatenate(umi_id_arrays)
+        tag_ids = np.concatenate(tag_id_arrays)
+        # Release the per-batch buffers before building the flat counter.
+        del cb_id_arrays, umi_id_arrays, tag_id_arrays, cb_index, umi_index
+        n_umis = len(umi_names)
+        keys = (cb_ids * (n_tags + 1) + tag_ids) * n_umis + umi_ids
+        (unique_keys, key_counts) = np.unique(keys, return_counts=True)
+        unique_umi_ids = unique_keys % n_umis
+        unique_keys //= n_umis
+        unique_tag_ids = unique_keys % (n_tags + 1)
+        unique_cb_ids = unique_keys // (n_tags + 1)
+        read_counts = np.bincount(cb_ids, minlength=len(cb_names))
+        umi_counts = np.bincount(unique_cb_ids, minlength=len(cb_names))
+        for cb_id, cell_barcode in enumerate(cb_names):
+            umis_per_cell[cell_barcode] = int(umi_counts[cb_id])
+            reads_per_cell[cell_barcode] = int(read_counts[cb_id])
+        for k in range(len(unique_keys)):
+            flat_results[
+                (
+                    cb_names[unique_cb_ids[k]],
+                    all_tag_names[unique_tag_ids[k]],
+                    umi_names[unique_umi_ids[k]],
                 )
-                sys.stdout.flush()
-            n += 1
+            ] = int(key_counts[k])
     print(
         "Mapping done for process {}. Processed {:,} reads".format(os.getpid(), n - 1)
     )
     sys.stdout.flush()
-    return (results, no_match)
+    return (flat_results, no_match, umis_per_cell, reads_per_cell)
 
 
 def merge_results(parallel_results):
     """Merge chunked results from parallel processing.
 
+    Each chunk carries a flat Counter keyed by (cell barcode, TAG, UMI), so
+    merging across workers is a single C-level Counter update per chunk; the
+    nested dict of dict of Counters is only built once at the end.
+
     Args:
-        parallel_results (list): List of dict with mapping results.
+        parallel_results (list): List of map_reads result tuples.
 
     Returns:
         merged_results (dict): Results combined as a dict of dict of Counters
@@ -208,26 +454,21 @@ def merge_results(parallel_results):
         reads_per_cell (Counter): Total reads per cell as a Counter
         merged_no_match (Counter): Unmapped tags as a Counter
     """
-    merged_results = {}
+    merged_flat = Counter()
     merged_no_match = Counter()
     umis_per_cell = Counter()
     reads_per_cell = Counter()
     for chunk in parallel_results:
-        mapped = chunk[0]
-        unmapped = chunk[1]
-        for cell_barcode in mapped:
-            if cell_barcode not in merged_results:
-                merged_results[cell_barcode] = defaultdict(Counter)
-            for TAG in mapped[cell_barcode]:
-                # Test the counter. Returns false if empty
-                if mapped[cell_barcode][TAG]:
-                    for UMI in mapped[cell_barcode][TAG]:
-                        merged_results[cell_barcode][TAG][UMI] += mapped[cell_barcode][
-                            TAG
-                        ][UMI]
-                        umis_per_cell[cell_barcode] += len(mapped[cell_barcode][TAG])
-                        reads_per_cell[cell_barcode] += mapped[cell_barcode][TAG][UMI]
+        (flat_results, unmapped, chunk_umis_per_cell, chunk_reads_per_cell) = chunk
+        merged_flat.update(flat_results)
         merged_no_match.update(unmapped)
+        umis_per_cell.update(chunk_umis_per_cell)
+        reads_per_cell.update(chunk_reads_per_cell)
+    merged_results = {}
+    for (cell_barcode, TAG, UMI), read_count in merged_flat.items():
+        if cell_barcode not in merged_results:
+            merged_results[cell_barcode] = defaultdict(Counter)
+        merged_results[cell_barcode][TAG][UMI] = read_count
     return (merged_results, umis_per_cell, reads_per_cell, merged_no_match)
 
 
@@ -253,10 +494,17 @@ def correct_umis(final_results, collapsing_threshold, top_cells, max_umis):
         for TAG in final_results[cell_barcode]:
             n_umis = len(final_results[cell_barcode][TAG])
             if n_umis > 1 and n_umis <= max_umis:
-                umi_clusters = network.UMIClusterer()
-                UMIclusters = umi_clusters(
-                    final_results[cell_barcode][TAG], collapsing_threshold
-                )
+                if n_umis <= MAX_VECTORIZED_UMIS:
+                    UMIclusters = _cluster_umis_vectorized(
+                        final_results[cell_barcode][TAG], collapsing_threshold
+                    )
+                else:
+                    # The pairwise distance matrix would get too big; let
+                    # umi_tools handle the rare oversized groups.
+                    umi_clusters = network.UMIClusterer()
+                    UMIclusters = umi_clusters(
+                        final_results[cell_barcode][TAG], collapsing_threshold
+                    )
                 (new_res, temp_corrected_umis) = update_umi_counts(
                     UMIclusters, final_results[cell_barcode][TAG]
                 )
@@ -267,6 +515,60 @@ def correct_umis(final_results, collapsing_threshold, top_cells, max_umis):
     return (final_results, corrected_umis, aberrant_umi_count_cells)
 
 
+def _cluster_umis_vectorized(umi_counts, collapsing_threshold):
+    """
+    Clusters the umis of one cell/tag group with the directional method.
+
+    Replicates umi_tools' directional clustering, but computes all pairwise
+    Hamming distances in one vectorized numpy pass over a uint8 matrix of
+    the UMI bytes instead of one Python-level call per pair.
+
+    Args:
+        umi_counts (Counter): Counter of umis.
+        collapsing_threshold (int): Max distance between umis.
+
+    Returns:
+        clusters (list): List of lists of umis, the dominant umi first.
+    """
+    umis = list(umi_counts)
+    n_umis = len(umis)
+    umi_length = len(umis[0])
+    umis_arr = np.frombuffer(b"".join(umis), dtype=np.uint8).reshape(
+        n_umis, umi_length
+    )
+    counts_arr = np.fromiter((umi_counts[umi] for umi in umis), dtype=np.int64)
+    distances = np.count_nonzero(
+        umis_arr[:, None, :] != umis_arr[None, :, :], axis=2
+    )
+    # Directional edge i -> j requires closeness and a dominant count.
+    adjacency = (distances <= collapsing_threshold) & (
+        counts_arr[:, None] >= 2 * counts_arr[None, :] - 1
+    )
+    np.fill_diagonal(adjacency, False)
+
+    seeded = np.zeros(n_umis, dtype=bool)
+    observed = np.zeros(n_umis, dtype=bool)
+    clusters = []
+    for seed in np.argsort(-counts_arr, kind="stable"):
+        if seeded[seed]:
+            continue
+        members = {int(seed)}
+        queue = [int(seed)]
+        while queue:
+            node = queue.pop()
+            for neighbour in np.nonzero(adjacency[node])[0]:
+                neighbour = int(neighbour)
+                if neighbour not in members:
+                    members.add(neighbour)
+                    queue.append(neighbour)
+        member_order = sorted(members, key=lambda index: -counts_arr[index])
+        cluster = [umis[index] for index in member_order if not observed[index]]
+        seeded[member_order] = True
+        observed[member_order] = True
+        clusters.append(cluster)
+    return clusters
+
+
 def update_umi_counts(UMIclusters, cell_tag_counts):
     """
     Update a dict object with umis corrected.
@@ -315,16 +617,26 @@ def collapse_cells(true_to_false, umis_per_cell, final_results, ab_map):
             final_results[real_barcode] = defaultdict()
             for TAG in ab_map:
                 final_results[real_barcode][TAG] = Counter()
-        for fake_barcode in true_to_false[real_barcode]:
-            temp = final_results.pop(fake_barcode)
-            corrected_barcodes += 1
-            for TAG in temp.keys():
-                final_results[real_barcode][TAG].update(temp[TAG])
-            temp_umi_counts = umis_per_cell.pop(fake_barcode)
-            # temp_read_counts = reads_per_cell.pop(fake_barcode)
-
-            umis_per_cell[real_barcode] += temp_umi_counts
-            # reads_per_cell[real_barcode] += temp_read_counts
+        # Pop all contributing fake barcodes first, then merge each TAG once
+        # instead of growing the real barcode's Counters fake by fake.
+        fake_barcodes = true_to_false[real_barcode]
+        temp_results = [
+            final_results.pop(fake_barcode) for fake_barcode in fake_barcodes
+        ]
+        corrected_barcodes += len(temp_results)
+        tags_to_merge = set()
+        for temp in temp_results:
+            tags_to_merge.update(temp)
+        for TAG in tags_to_merge:
+            merged = Counter()
+            for temp in temp_results:
+                counts = temp.get(TAG)
+                if counts:
+                    merged.update(counts)
+            final_results[real_barcode][TAG].update(merged)
+        umis_per_cell[real_barcode] += sum(
+            umis_per_cell.pop(fake_barcode) for fake_barcode in fake_barcodes
+        )
 
     return (umis_per_cell, final_results, corrected_barcodes)
 
@@ -371,52 +683,73 @@ def correct_cells(
 
 
 def correct_cells_whitelist(
-    final_results, umis_per_cell, whitelist, collapsing_threshold, ab_map
+    final_results, umis_per_cell, whitelist, collapsing_threshold, ab_map, n_threads=1
 ):
     """
     Corrects cell barcodes.
-    
+
     Args:
         final_results (dict): Dict of dict of Counters with mapping results.
         umis_per_cell (Counter): Counter of UMIs per cell.
         whitelist (set): The whitelist reference given by the user.
         collapsing_threshold (int): Max distance between umis.
         ab_map (OrederedDict): Tags in an ordered dict.
+        n_threads (int): Number of threads to use.
+
 
-    
     Returns:
         final_results (dict): Same as input but with corrected umis.
         umis_per_cell (Counter): Updated UMI counts after correction.
         corrected_barcodes (int): How many umis have been corrected.
     """
-    barcode_tree = pybktree.BKTree(Levenshtein.hamming, whitelist)
-    print("Generated barcode tree from whitelist")
     cell_barcodes = list(final_results.keys())
     n_barcodes = len(cell_barcodes)
     print("Finding reference candidates")
     print("Processing {:,} cell barcodes".format(n_barcodes))
 
-    # Run with one process
-    true_to_false = find_true_to_false_map(
-        barcode_tree=barcode_tree,
-        cell_barcodes=cell_barcodes,
-        whitelist=whitelist,
-        collapsing_threshold=collapsing_threshold,
-    )
+    if n_threads <= 1 or n_barcodes < 100000:
+        # Run with one process
+        true_to_false = find_true_to_false_map(
+            cell_barcodes=cell_barcodes,
+            whitelist=whitelist,
+            collapsing_threshold=collapsing_threshold,
+        )
+    else:
+        # Shard the barcodes across workers and merge the partial mappings.
+        chunk_size = ceil(n_barcodes / n_threads)
+        barcode_chunks = [
+            cell_barcodes[i : i + chunk_size]
+            for i in range(0, n_barcodes, chunk_size)
+        ]
+        p = Pool(processes=n_threads)
+        parallel_maps = p.starmap(
+            find_true_to_false_map,
+            [
+                (barcode_chunk, whitelist, collapsing_threshold)
+                for barcode_chunk in barcode_chunks
+            ],
+        )
+        p.close()
+        p.join()
+        true_to_false = defaultdict(list)
+        for chunk_map in parallel_maps:
+            for white_cell_str in chunk_map:
+                true_to_false[white_cell_str].extend(chunk_map[white_cell_str])
     (umis_per_cell, final_results, corrected_barcodes) = collapse_cells(
         true_to_false, umis_per_cell, final_results, ab_map
     )
     return (final_results, umis_per_cell, corrected_barcodes)
 
 
-def find_true_to_false_map(
-    barcode_tree, cell_barcodes, whitelist, collapsing_threshold
-):
+def find_true_to_false_map(cell_barcodes, whitelist, collapsing_threshold):
     """
     Creates a mapping between "fake" cell barcodes and their original true barcode.
 
+    The whitelist is encoded once as a uint8 matrix; each observed barcode
+    is then compared to the whole whitelist in one vectorized Hamming pass
+    instead of a Python-level BKTree traversal.
+
     Args:
-        barcode_tree (BKTree): BKTree of all original cell barcodes.
         cell_barcodes (List): Cell barcodes to go through.
         whitelist (Set): Set of the whitelist, the "true" cell barcodes.
         collasping_threshold (int): How many mistakes to correct.
@@ -425,27 +758,28 @@ def find_true_to_false_map(
         true_to_false (defaultdict(list)): Contains the mapping between the fake and real barcodes. The key is the real one.
     """
     true_to_false = defaultdict(list)
-    for i, cell_barcode in enumerate(cell_barcodes):
-        if cell_barcode in whitelist:
+    whitelist_ordered = list(whitelist)
+    whitelist_set = set(whitelist_ordered)
+    barcode_length = len(whitelist_ordered[0])
+    whitelist_arr = np.frombuffer(
+        "".join(whitelist_ordered).encode("ascii"), dtype=np.uint8
+    ).reshape(-1, barcode_length)
+    for cell_barcode in cell_barcodes:
+        if cell_barcode in whitelist_set:
             # if the barcode is already whitelisted, no need to add
             continue
+        barcode_arr = np.frombuffer(cell_barcode.encode("ascii"), dtype=np.uint8)
         # get all members of whitelist that are at distance of collapsing_threshold
-        candidates = [
-            white_cell
-            for d, white_cell in barcode_tree.find(cell_barcode, collapsing_threshold)
-            if d > 0
-        ]
+        distances = np.count_nonzero(whitelist_arr != barcode_arr, axis=1)
+        candidates = np.nonzero(distances <= collapsing_threshold)[0]
         if len(candidates) == 1:
-            white_cell_str = candidates[0]
+            white_cell_str = whitelist_ordered[candidates[0]]
             true_to_false[white_cell_str].append(cell_barcode)
-        elif len(candidates) == 0:
-            # the cell doesnt match to any whitelisted barcode,
-            # hence we have to drop it
-            # (as it cannot be asscociated with any frequent barcode)
-            continue
         else:
-            # more than on whitelisted candidate:
-            # we drop it as its not uniquely assignable
+            # either the cell doesnt match to any whitelisted barcode
+            # (as it cannot be asscociated with any frequent barcode)
+            # or it matches more than one whitelisted candidate and
+            # is not uniquely assignable; we drop it in both cases
             continue
     return true_to_false
 
@@ -459,24 +793,35 @@ def generate_sparse_matrices(final_results, ordered_tags_map, top_cells):
         ordered_tags_map (dict): Tags in order with indexes as values.
 
     Returns:
-        umi_results_matrix (scipy.sparse.dok_matrix): UMI counts
-        read_results_matrix (scipy.sparse.dok_matrix): Read counts
+        umi_results_matrix (scipy.sparse.coo_matrix): UMI counts
+        read_results_matrix (scipy.sparse.coo_matrix): Read counts
 
     """
-    umi_results_matrix = sparse.dok_matrix(
-        (len(ordered_tags_map), len(top_cells)), dtype=int32
-    )
-    read_results_matrix = sparse.dok_matrix(
-        (len(ordered_tags_map), len(top_cells)), dtype=int32
-    )
+    # First pass determines the number of non-zero entries.
+    n_entries = 0
+    for cell_barcode in top_cells:
+        for TAG in final_results[cell_barcode]:
+            if final_results[cell_barcode][TAG]:
+                n_entries += 1
+    rows = np.empty(n_entries, dtype=int32)
+    cols = np.empty(n_entries, dtype=int32)
+    umi_data = np.empty(n_entries, dtype=int32)
+    read_data = np.empty(n_entries, dtype=int32)
+    k = 0
     for i, cell_barcode in enumerate(top_cells):
-        for j, TAG in enumerate(final_results[cell_barcode]):
+        for TAG in final_results[cell_barcode]:
             if final_results[cell_barcode][TAG]:
-                umi_results_matrix[ordered_tags_map[TAG], i] = len(
-                    final_results[cell_barcode][TAG]
-                )
-                read_results_matrix[ordered_tags_map[TAG], i] = sum(
-                    final_results[cell_barcode][TAG].values()
-                )
+                rows[k] = ordered_tags_map[TAG]
+                cols[k] = i
+                umi_data[k] = len(final_results[cell_barcode][TAG])
+                read_data[k] = sum(final_results[cell_barcode][TAG].values())
+                k += 1
+    shape = (len(ordered_tags_map), len(top_cells))
+    umi_results_matrix = sparse.coo_matrix(
+        (umi_data, (rows, cols)), shape=shape, dtype=int32
+    )
+    read_results_matrix = sparse.coo_matrix(
+        (read_data, (rows, cols)), shape=shape, dtype=int32
+    )
     return (umi_results_matrix, read_results_matrix)
 
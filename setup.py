@@ -19,13 +19,15 @@ setuptools.setup(
     ),
     install_requires=[
         "python-levenshtein>=0.12.0",
+        "numpy>=1.15.0",
+        "numba>=0.45.0",
         "scipy>=1.1.0",
+        "fast-matrix-market>=1.4.0",
         "multiprocess>=0.70.6.1",
         "umi_tools==1.0.0",
+        "pyahocorasick>=1.4.0",
         "pytest==4.1.0",
         "pytest-dependency==0.4.0",
-        "pandas>=0.23.4",
-        "pybktree==1.1",
     ],
     python_requires=">=3.6",
 )
@@ -147,7 +147,7 @@ def test_find_best_match_with_3_distance_reverse(data):
     'test_find_best_match_with_3_distance',
     'test_find_best_match_with_3_distance_reverse',])
 def test_classify_reads_multi_process(data):
-    (results, no_match) = processing.map_reads(
+    mapping_result = processing.map_reads(
         pytest.correct_R1_path,
         pytest.correct_R2_path,
         pytest.tags,
@@ -159,7 +159,11 @@ def test_classify_reads_multi_process(data):
         pytest.start_trim,
         pytest.maximum_distance,
         pytest.sliding_window)
+    (results, umis_per_cell, reads_per_cell, no_match) = processing.merge_results(
+        [mapping_result])
     assert len(results) == 2
+    assert len(umis_per_cell) == 2
+    assert len(reads_per_cell) == 2
 
 
 @pytest.mark.dependency(depends=['test_classify_reads_multi_process'])